@@ -171,8 +171,7 @@ class FNOFactorized2DBlock(nn.Module):
         x = self.in_proj(x)
         x = self.drop(x)
         forecast_list = []
-        for i in range(self.n_layers):
-            layer = self.spectral_layers[i]
+        for layer in self.spectral_layers:
             b, f = layer(x)
 
             if self.use_fork:
@@ -1,9 +1,9 @@
-import h5py as h5
+from functools import lru_cache
 import numpy as np
-from scipy.stats import qmc
-import matplotlib.pyplot as plt
 
 DX = 0.03125 # Grid spacing in FlashX simulations
+SITE_BLOCK = 8 # Sites broadcast together, bounds peak memory to a few grid-sized arrays
+DFUN_DTYPE = np.float32 # Precision of the distance function, single precision is plenty for seeding
 
 def heater_init(xmin, xmax, num_sites):
     r"""
@@ -18,24 +18,32 @@ def heater_init(xmin, xmax, num_sites):
     Returns:
         numpy.ndarray: The coordinates of the heater nucleation sites.
     """
-    x_sites = np.ndarray(num_sites, dtype=float)
-    y_sites = np.ndarray(num_sites, dtype=float)
+    halton_sample = _halton_sample(num_sites)
 
-    halton_sequence = qmc.Halton(d=2, seed=1)
-    halton_sample = halton_sequence.random(num_sites)
-
-    x_sites[:] = xmin + halton_sample[:, 0] * (xmax - xmin) 
-    y_sites[:] = 1e-13
+    x_sites = xmin + halton_sample[:, 0] * (xmax - xmin)
+    y_sites = np.full(num_sites, 1e-13)
 
     return x_sites, y_sites
 
-def dfun_init(x_grid, y_grid, x_sites, y_sites, seed_radius):
+@lru_cache(maxsize=None)
+def _halton_sample(num_sites):
+    r"""
+    The seeded Halton sample is deterministic, so it is drawn once per site count.
+    The cached array is read-only since it is shared between calls.
+    """
+    from scipy.stats import qmc
+
+    halton_sample = qmc.Halton(d=2, seed=1).random(num_sites)
+    halton_sample.setflags(write=False)
+    return halton_sample
+
+def dfun_init(coordx, coordy, x_sites, y_sites, seed_radius):
     r"""
     Initialize the distance function for given nucleation sites.
 
     Args:
-        x_grid (numpy.ndarray): The x-coordinates of the grid.
-        y_grid (numpy.ndarray): The y-coordinates of the grid.
+        coordx (numpy.ndarray): The x-coordinates of the first row of the grid.
+        coordy (numpy.ndarray): The y-coordinates of the first column of the grid.
         x_sites (numpy.ndarray): The x-coordinates of the nucleation sites.
         y_sites (numpy.ndarray): The y-coordinates of the nucleation sites.
         seed_radius (float): The radius of the nucleation site.
@@ -43,15 +51,90 @@ def dfun_init(x_grid, y_grid, x_sites, y_sites, seed_radius):
     Returns:
         numpy.ndarray: The initial distance function with nucleated bubbles.
     """
-    dfun = np.zeros_like(x_grid) - np.inf
-    seed_height = seed_radius * np.cos(np.pi/4)
-    for htr_points_xy in zip(x_sites, y_sites):
-        seed_x = htr_points_xy[0]
-        seed_y = htr_points_xy[1] + seed_height
+    coordx, coordy = np.asarray(coordx, dtype=DFUN_DTYPE), np.asarray(coordy, dtype=DFUN_DTYPE)
+    dfun = np.full((len(coordy), len(coordx)), -np.inf, dtype=DFUN_DTYPE)
+    seed_radius = DFUN_DTYPE(seed_radius)
+    seed_height = seed_radius * DFUN_DTYPE(np.cos(np.pi/4))
+    return _seed_bubbles(dfun, coordx, coordy,
+                         np.asarray(x_sites, dtype=DFUN_DTYPE),
+                         np.asarray(y_sites, dtype=DFUN_DTYPE) + seed_height, seed_radius)
 
-        interim_dfun = seed_radius - np.sqrt((x_grid - seed_x)**2 + (y_grid - seed_y)**2)
-        dfun = np.maximum(dfun, interim_dfun)
-    return dfun
+def _seed_bubbles(dfun, coordx, coordy, seed_x, seed_y, seed_radius):
+    r"""
+    Seed bubbles of radius seed_radius centered at (seed_x, seed_y) into dfun, in-place.
+
+    Args:
+        dfun (numpy.ndarray): The distance function to update.
+        coordx (numpy.ndarray): The x-coordinates of the first row of the grid.
+        coordy (numpy.ndarray): The y-coordinates of the first column of the grid.
+        seed_x (numpy.ndarray): The x-coordinates of the bubble centers.
+        seed_y (numpy.ndarray): The y-coordinates of the bubble centers.
+        seed_radius (float): The radius of the nucleation site.
+
+    Returns:
+        numpy.ndarray: The updated distance function.
+    """
+    # dfun is C-contiguous, the callers allocate or copy it in DFUN_DTYPE.
+    coordx, coordy = np.ascontiguousarray(coordx), np.ascontiguousarray(coordy)
+    seed_x, seed_y = np.ascontiguousarray(seed_x), np.ascontiguousarray(seed_y)
+    return _seed_bubbles_kernel()(dfun, coordx, coordy, seed_x, seed_y, seed_radius)
+
+def _broadcast_dist2(coordx, coordy, seed_x, seed_y, xp=np):
+    r"""
+    Squared distance from every grid cell to the nearest site, by brute force.
+    xp is the array module of the inputs, numpy or cupy.
+    """
+    # The grid is rectilinear, so each coordinate only varies along one axis.
+    # Broadcasting the 1-D axes against a block of sites avoids building a
+    # full grid-sized temporary for every site.
+    # The grid-sized buffers are allocated once and reused for every block.
+    shape = (len(coordy), len(coordx))
+    dist2 = xp.full(shape, xp.inf, dtype=coordx.dtype)
+    block_dist2 = xp.empty((min(SITE_BLOCK, len(seed_x)),) + shape, dtype=coordx.dtype)
+    block_min = xp.empty(shape, dtype=coordx.dtype)
+    for start in range(0, len(seed_x), SITE_BLOCK):
+        dx = coordx[None, None, :] - seed_x[start:start+SITE_BLOCK, None, None]
+        dy = coordy[None, :, None] - seed_y[start:start+SITE_BLOCK, None, None]
+        block = block_dist2[:len(dx)]
+        xp.add(dx*dx, dy*dy, out=block)
+        block.min(axis=0, out=block_min)
+        xp.minimum(dist2, block_min, out=dist2)
+    return dist2
+
+@lru_cache(maxsize=None)
+def _seed_bubbles_kernel():
+    r"""
+    Compile the Numba kernel behind _seed_bubbles on first use, so importing this module stays cheap.
+    """
+    import numba as nb
+
+    # fastmath without the nnan/ninf flags, since dfun starts out at -inf.
+    @nb.njit(parallel=True, fastmath={'contract', 'arcp', 'reassoc', 'nsz'})
+    def seed_bubbles_nb(dfun, coordx, coordy, seed_x, seed_y, seed_radius):
+        r"""
+        Numba kernel behind _seed_bubbles. Rows of the grid are processed in parallel.
+        Within a row the sites are the outer loop, so the contiguous inner loop
+        over columns vectorizes and dy*dy is computed once per site.
+        """
+        rows, cols = dfun.shape
+        for i in nb.prange(rows):
+            row_dist2 = np.full(cols, np.inf, dtype=dfun.dtype)
+            for k in range(len(seed_x)):
+                dy = coordy[i] - seed_y[k]
+                dy2 = dy*dy
+                sx = seed_x[k]
+                for j in range(cols):
+                    dx = coordx[j] - sx
+                    row_dist2[j] = min(row_dist2[j], dx*dx + dy2)
+            for j in range(cols):
+                # seed_radius - sqrt(dist2) is monotonic in dist2, so the sqrt is only
+                # needed where the nearest bubble beats the current dfun.
+                reach = seed_radius - dfun[i, j]
+                if reach > 0 and row_dist2[j] < reach*reach:
+                    dfun[i, j] = seed_radius - np.sqrt(row_dist2[j])
+        return dfun
+
+    return seed_bubbles_nb
 
 def tag_renucleation(x_sites, y_sites, dfun, coordx, coordy, seed_radius, curr_iter, nuc_wait_time=0.4):
     r"""
@@ -69,59 +152,155 @@ def tag_renucleation(x_sites, y_sites, dfun, coordx, coordy, seed_radius, curr_i
     Returns:
         numpy.ndarray: The tagged nucleation sites.
     """
-    tagged_sites = np.zeros_like(x_sites, dtype=bool)
     nuc_plot_interval = nuc_wait_time * 10
     seed_height = seed_radius * np.cos(np.pi/4)
-    for i, htr_points_xy in enumerate(zip(x_sites, y_sites)):
-        seed_x = htr_points_xy[0]
-        seed_y = htr_points_xy[1] + seed_height
-        x_i = np.searchsorted(coordx, seed_x)
-        y_i = np.searchsorted(coordy, seed_y)
+    # searchsorted gives the first cell center at or past the site, so the site
+    # lies between cells i-1 and i. Clip so sites at the domain edge stay in bounds.
+    x_i = np.clip(np.searchsorted(coordx, x_sites), 1, len(coordx) - 1)
+    y_i = np.clip(np.searchsorted(coordy, np.asarray(y_sites) + seed_height), 1, len(coordy) - 1)
 
-        dfun_site = (dfun[y_i, x_i] + dfun[y_i+1, x_i] + dfun[y_i, x_i+1] + dfun[y_i+1, x_i+1])/4.0  # Average of the 4 cells surrounding the nucleation site
-
-        if dfun_site < 0 and curr_iter % nuc_plot_interval == 0:
-            tagged_sites[i] = True
+    dfun_sites = (dfun[y_i, x_i] + dfun[y_i-1, x_i] + dfun[y_i, x_i-1] + dfun[y_i-1, x_i-1])/4.0  # Average of the 4 cells surrounding the nucleation site
 
+    tagged_sites = (dfun_sites < 0) & (curr_iter % nuc_plot_interval == 0)
     return tagged_sites
     
-def renucleate(x_grid, y_grid, x_sites, y_sites, tagged_sites, curr_dfun, seed_radius):
+def renucleate(coordx, coordy, x_sites, y_sites, tagged_sites, curr_dfun, seed_radius, local=False):
     r"""
     Renucleate the sites that are tagged for renucleation.
 
     Args:
-        x_grid (numpy.ndarray): The x-coordinates of the grid.
-        y_grid (numpy.ndarray): The y-coordinates of the grid.
+        coordx (numpy.ndarray): The x-coordinates of the first row of the grid.
+        coordy (numpy.ndarray): The y-coordinates of the first column of the grid.
         x_sites (numpy.ndarray): The x-coordinates of the nucleation sites.
         y_sites (numpy.ndarray): The y-coordinates of the nucleation sites.
+        tagged_sites (numpy.ndarray): Boolean mask of the sites to renucleate.
         curr_dfun (numpy.ndarray): The distance function at the current time.
         seed_radius (float): The radius of the nucleation site.
+        local (bool): Only update the cells inside the seeded bubbles. Much cheaper on
+            fine grids, but the negative distance outside the bubbles is left as is.
 
     Returns:
-        numpy.ndarray: The updated nucleation sites.
+        numpy.ndarray: The updated distance function.
     """
-    seed_height = seed_radius * np.cos(np.pi/4)
-    for i, htr_points_xy in enumerate(zip(x_sites, y_sites)):
-        if tagged_sites[i]:
-            seed_x = htr_points_xy[0]
-            seed_y = htr_points_xy[1] + seed_height
+    tagged_sites = np.asarray(tagged_sites, dtype=bool)
+    # A C-ordered copy, so the caller's array is untouched and every layout takes the same kernel.
+    curr_dfun = np.array(curr_dfun, dtype=DFUN_DTYPE, order='C')
+    if not tagged_sites.any():
+        return curr_dfun
+    seed_radius = DFUN_DTYPE(seed_radius)
+    seed_height = seed_radius * DFUN_DTYPE(np.cos(np.pi/4))
+    seed_bubbles = _seed_bubbles_local if local else _seed_bubbles
+    return seed_bubbles(curr_dfun,
+                        np.asarray(coordx, dtype=DFUN_DTYPE), np.asarray(coordy, dtype=DFUN_DTYPE),
+                        np.asarray(x_sites, dtype=DFUN_DTYPE)[tagged_sites],
+                        np.asarray(y_sites, dtype=DFUN_DTYPE)[tagged_sites] + seed_height, seed_radius)
 
-            interim_dfun = seed_radius - np.sqrt((x_grid - seed_x)**2 + (y_grid - seed_y)**2)
-            curr_dfun = np.maximum(curr_dfun, interim_dfun)
-    
-    return curr_dfun
+def _seed_bubbles_local(dfun, coordx, coordy, seed_x, seed_y, seed_radius):
+    r"""
+    Seed bubbles into dfun in-place, only touching the cells inside each bubble.
+    Every bubble has the same radius, so one disc of index offsets is shared by
+    all sites and the work per site no longer scales with the grid size.
+    """
+    # Pad the disc by two cells, since sites sit between cell centers.
+    spacing = min(np.diff(coordx).min(), np.diff(coordy).min())
+    drow, dcol = _disc_offsets(int(np.ceil(seed_radius / spacing)) + 2)
+
+    rows = np.searchsorted(coordy, seed_y)[:, None] + drow
+    cols = np.searchsorted(coordx, seed_x)[:, None] + dcol
+    in_grid = (rows >= 0) & (rows < len(coordy)) & (cols >= 0) & (cols < len(coordx))
+    rows, cols = np.where(in_grid, rows, 0), np.where(in_grid, cols, 0)
+
+    dx = coordx[cols] - seed_x[:, None]
+    dy = coordy[rows] - seed_y[:, None]
+    interim_dfun = seed_radius - np.sqrt(dx*dx + dy*dy)
+    inside = in_grid & (interim_dfun > 0)
+    np.maximum.at(dfun, (rows[inside], cols[inside]), interim_dfun[inside])
+    return dfun
+
+@lru_cache(maxsize=None)
+def _disc_offsets(radius_cells):
+    r"""
+    Row and column offsets of the cells within radius_cells of a cell.
+    The cached arrays are read-only since they are shared between calls.
+    """
+    drow, dcol = np.mgrid[-radius_cells:radius_cells+1, -radius_cells:radius_cells+1]
+    disc = drow**2 + dcol**2 <= radius_cells**2
+    drow, dcol = drow[disc].astype(np.int32), dcol[disc].astype(np.int32)
+    drow.setflags(write=False)
+    dcol.setflags(write=False)
+    return drow, dcol
+
+
+def dfun_init_gpu(coordx, coordy, x_sites, y_sites, seed_radius):
+    r"""
+    Initialize the distance function for given nucleation sites on the GPU with CuPy.
+    Arguments match dfun_init and may be NumPy or CuPy arrays.
+
+    Returns:
+        cupy.ndarray: The initial distance function with nucleated bubbles.
+    """
+    cp = _require_cupy()
+    coordx, coordy = cp.asarray(coordx, dtype=DFUN_DTYPE), cp.asarray(coordy, dtype=DFUN_DTYPE)
+    dfun = cp.full((len(coordy), len(coordx)), -cp.inf, dtype=DFUN_DTYPE)
+    seed_radius = DFUN_DTYPE(seed_radius)
+    seed_height = seed_radius * DFUN_DTYPE(np.cos(np.pi/4))
+    return _seed_bubbles_gpu(dfun, coordx, coordy,
+                             cp.asarray(x_sites, dtype=DFUN_DTYPE),
+                             cp.asarray(y_sites, dtype=DFUN_DTYPE) + seed_height, seed_radius)
+
+def renucleate_gpu(coordx, coordy, x_sites, y_sites, tagged_sites, curr_dfun, seed_radius):
+    r"""
+    Renucleate the sites that are tagged for renucleation on the GPU with CuPy.
+    Arguments match renucleate and may be NumPy or CuPy arrays.
+
+    Returns:
+        cupy.ndarray: The updated distance function.
+    """
+    cp = _require_cupy()
+    tagged_sites = cp.asarray(tagged_sites, dtype=bool)
+    curr_dfun = cp.array(curr_dfun, dtype=DFUN_DTYPE)
+    if not tagged_sites.any():
+        return curr_dfun
+    seed_radius = DFUN_DTYPE(seed_radius)
+    seed_height = seed_radius * DFUN_DTYPE(np.cos(np.pi/4))
+    return _seed_bubbles_gpu(curr_dfun,
+                             cp.asarray(coordx, dtype=DFUN_DTYPE), cp.asarray(coordy, dtype=DFUN_DTYPE),
+                             cp.asarray(x_sites, dtype=DFUN_DTYPE)[tagged_sites],
+                             cp.asarray(y_sites, dtype=DFUN_DTYPE)[tagged_sites] + seed_height, seed_radius)
+
+def _seed_bubbles_gpu(dfun, coordx, coordy, seed_x, seed_y, seed_radius):
+    r"""
+    CuPy version of _seed_bubbles. Returns a new array instead of updating dfun in-place.
+    """
+    # Every cell is a GPU thread, so a branch-free max beats masking out the sqrt.
+    cp = _require_cupy()
+    dist2 = _broadcast_dist2(coordx, coordy, seed_x, seed_y, xp=cp)
+    return cp.maximum(dfun, seed_radius - cp.sqrt(dist2))
+
+def _require_cupy():
+    r"""
+    Import CuPy for the GPU functions, with a clear error if it is not installed.
+    """
+    try:
+        import cupy as cp
+    except ImportError:
+        raise ImportError('CuPy is required for GPU nucleation, install it with `pip install cupy`.')
+    return cp
 
 
 if __name__ == '__main__':
+    import h5py as h5
+    import matplotlib.pyplot as plt
+
     sim = h5.File('/Users/shakeel/bubbleml_data/PoolBoiling-WallSuperheat-FC72-2D/Twall-100.hdf5', 'r')
     dfun_0 = sim['dfun'][...][0]
     x_0, y_0 = sim['x'][...][0], sim['y'][...][0]
-    coordx, coordy = x_0[0], np.transpose(y_0)[0]
+    coordx, coordy = x_0[0].astype(np.float32), np.transpose(y_0)[0].astype(np.float32)
     
 
     init_nucl_coordx, init_nucl_coordy = heater_init(-5.0, 5.0, 40) # Coordinates of 40 nucleation sites
 
-    my_dfun = dfun_init(x_0, y_0, init_nucl_coordx, init_nucl_coordy, seed_radius=0.1) # Initialize the distance function with nucleated bubbles at t-0
+    my_dfun = dfun_init(coordx, coordy, init_nucl_coordx, init_nucl_coordy, seed_radius=0.1) # Initialize the distance function with nucleated bubbles at t-0
     
     # Plot the initial distance function for testing
     my_dfun[my_dfun>0] *= (255/my_dfun.max())
@@ -130,11 +309,11 @@ if __name__ == '__main__':
     plt.imsave(f'my_dfun.png', np.flipud(my_dfun), cmap='GnBu')
     plt.close()
 
-    dfun_40 = sim['dfun'][...][40]
+    dfun_40 = sim['dfun'][...][40].astype(np.float32)
 
     # Renucleation algorithm
     tagged_nucl_sites = tag_renucleation(init_nucl_coordx, init_nucl_coordy, dfun_40, coordx, coordy, seed_radius=0.1, curr_iter=40, nuc_wait_time=0.4) 
-    dfun_40 = renucleate(x_0, y_0, init_nucl_coordx, init_nucl_coordy, tagged_nucl_sites, dfun_40, seed_radius=0.1) 
+    dfun_40 = renucleate(coordx, coordy, init_nucl_coordx, init_nucl_coordy, tagged_nucl_sites, dfun_40, seed_radius=0.1) 
 
     # Plot the distance function at t=40 after renucleation for testing 
     dfun_40[dfun_40>0] *= (255/dfun_40.max())